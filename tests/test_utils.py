@@ -12,13 +12,15 @@
 
 """Test for different utility functionality."""
 
+from io import BytesIO
 from tempfile import TemporaryFile
-from copy import deepcopy
+from dataclasses import replace
 
-from numpy import array
+from numpy import array, concatenate
 from numpy.random import rand
 from numpy.testing import assert_array_almost_equal, assert_raises
-from torch import Tensor, load, save
+from torch import Tensor, cat, load, save
+from torch.cuda import empty_cache
 from torch.nn import Module, Sequential
 from torch.nn.functional import mse_loss
 
@@ -27,6 +29,7 @@ from aihwkit.optim import AnalogSGD
 from aihwkit.simulator.configs import SingleRPUConfig, FloatingPointRPUConfig
 from aihwkit.simulator.configs.devices import ConstantStepDevice, LinearStepDevice
 from aihwkit.simulator.configs.utils import IOParameters, UpdateParameters
+from aihwkit.simulator.rpu_base import cuda
 from aihwkit.exceptions import TileError, ModuleError
 
 from .helpers.decorators import parametrize_over_layers
@@ -43,39 +46,83 @@ from .helpers.tiles import FloatingPoint, ConstantStep, Inference
 class SerializationTest(ParametrizedTestCase):
     """Tests for serialization."""
 
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+
+        # Build the training batches once, using the largest shapes of the
+        # default layers in ``.helpers.layers``.
+        cls._conv_batch = (Tensor(rand(2, 2, 3, 3))*0.2, Tensor(rand(2, 3, 4, 4))*0.2)
+        cls._linear_batch = (Tensor(rand(2, 3))*0.2, Tensor(rand(2, 4))*0.2)
+
+        if cls.use_cuda and cuda.is_compiled():
+            cls._conv_batch = tuple(item.pin_memory() for item in cls._conv_batch)
+            cls._linear_batch = tuple(item.pin_memory() for item in cls._linear_batch)
+
+    def tearDown(self) -> None:
+        if self.use_cuda:
+            empty_cache()
+
+        super().tearDown()
+
     @staticmethod
     def train_model(model, loss_func, x_b, y_b):
         """Train the model."""
         opt = AnalogSGD(model.parameters(), lr=0.5)
         opt.regroup_param_groups(model)
 
-        epochs = 1
-        for _ in range(epochs):
-            pred = model(x_b)
-            loss = loss_func(pred, y_b)
+        # A single update is enough to move the tile weights; the optimizer is
+        # discarded afterwards, so the gradients do not need to be reset.
+        pred = model(x_b)
+        loss = loss_func(pred, y_b)
 
-            loss.backward()
-            opt.step()
-            opt.zero_grad()
+        loss.backward()
+        opt.step()
 
     @staticmethod
     def get_layer_and_tile_weights(model):
         """Return the weights and biases of the model and the tile."""
-        weight = model.weight.data.detach().cpu().numpy()
-        if model.use_bias:
-            bias = model.bias.data.detach().cpu().numpy()
+        weight = model.weight.data.detach()
+        bias = model.bias.data.detach() if model.use_bias else None
+
+        if weight.is_cuda and bias is not None:
+            # Copy the layer weights and biases to host in a single transfer.
+            packed = cat([weight.flatten(), bias.flatten()]).cpu().numpy()
+            bias = packed[weight.numel():].reshape(bias.shape)
+            weight = packed[:weight.numel()].reshape(weight.shape)
         else:
-            bias = None
+            weight = weight.cpu().numpy()
+            bias = bias.cpu().numpy() if bias is not None else None
 
+        # The tile weights are always returned as CPU tensors.
         analog_weight, analog_bias = model.analog_tile.get_weights()
-        analog_weight = analog_weight.detach().cpu().numpy().reshape(weight.shape)
+        analog_weight = analog_weight.detach().numpy().reshape(weight.shape)
         if model.use_bias:
-            analog_bias = analog_bias.detach().cpu().numpy()
+            analog_bias = analog_bias.detach().numpy()
         else:
             analog_bias = None
 
         return weight, bias, analog_weight, analog_bias
 
+    @staticmethod
+    def pack_weights(*arrays):
+        """Return the given weights and biases flattened into a single array.
+
+        Arrays that are ``None`` (biases of layers without bias) are skipped.
+        """
+        return concatenate([item.ravel() for item in arrays if item is not None])
+
+    @staticmethod
+    def save_and_load(obj, to_disk=False):
+        """Save an object to an in-memory buffer and load it back.
+
+        If ``to_disk`` is set, a temporary file is used instead of the buffer.
+        """
+        with (TemporaryFile() if to_disk else BytesIO()) as file:
+            save(obj, file)
+            file.seek(0)
+            return load(file)
+
     def test_save_load_state_dict_train(self):
         """Test saving and loading using a state dict after training."""
         model = self.get_layer()
@@ -83,15 +130,15 @@ class SerializationTest(ParametrizedTestCase):
         # Perform an update in order to modify tile weights and biases.
         loss_func = mse_loss
         if isinstance(model, AnalogConv2d):
-            input_x = Tensor(rand(2, 2, 3, 3))*0.2
-            input_y = Tensor(rand(2, 3, 4, 4))*0.2
+            input_x, input_y = self._conv_batch
         else:
-            input_x = Tensor(rand(2, model.in_features))*0.2
-            input_y = Tensor(rand(2, model.out_features))*0.2
+            input_x, input_y = self._linear_batch
+            input_x = input_x[:, :model.in_features]
+            input_y = input_y[:, :model.out_features]
 
         if self.use_cuda:
-            input_x = input_x.cuda()
-            input_y = input_y.cuda()
+            input_x = input_x.cuda(non_blocking=True)
+            input_y = input_y.cuda(non_blocking=True)
 
         self.train_model(model, loss_func, input_x, input_y)
 
@@ -104,23 +151,19 @@ class SerializationTest(ParametrizedTestCase):
         if self.bias:
             assert_raises(AssertionError, assert_array_almost_equal, model_biases, tile_biases)
 
-        # Save the model to a file.
-        with TemporaryFile() as file:
-            save(model.state_dict(), file)
-            # Create a new model and load its state dict.
-            file.seek(0)
-            new_model = self.get_layer()
-            new_model.load_state_dict(load(file))
+        # Save the model to a file, create a new model and load its state dict.
+        state_dict = self.save_and_load(model.state_dict())
+        new_model = self.get_layer()
+        new_model.load_state_dict(state_dict)
 
         # Compare the new model weights and biases. they should now be in sync
         (new_model_weights, new_model_biases,
          new_tile_weights, new_tile_biases) = self.get_layer_and_tile_weights(new_model)
 
-        assert_array_almost_equal(tile_weights, new_model_weights)
-        assert_array_almost_equal(tile_weights, new_tile_weights)
-        if self.bias:
-            assert_array_almost_equal(tile_biases, new_model_biases)
-            assert_array_almost_equal(tile_biases, new_tile_biases)
+        assert_array_almost_equal(
+            self.pack_weights(tile_weights, tile_biases, tile_weights, tile_biases),
+            self.pack_weights(new_model_weights, new_model_biases,
+                              new_tile_weights, new_tile_biases))
 
     def test_save_load_model(self):
         """Test saving and loading a model directly."""
@@ -129,26 +172,20 @@ class SerializationTest(ParametrizedTestCase):
         # Keep track of the current weights and biases for comparing.
         (model_weights, model_biases,
          tile_weights, tile_biases) = self.get_layer_and_tile_weights(model)
-        assert_array_almost_equal(model_weights, tile_weights)
-        if self.bias:
-            assert_array_almost_equal(model_biases, tile_biases)
+        assert_array_almost_equal(self.pack_weights(model_weights, model_biases),
+                                  self.pack_weights(tile_weights, tile_biases))
 
-        # Save the model to a file.
-        with TemporaryFile() as file:
-            save(model, file)
-            # Load the model.
-            file.seek(0)
-            new_model = load(file)
+        # Save the model to a file and load it back.
+        new_model = self.save_and_load(model, to_disk=True)
 
         # Compare the new model weights and biases.
         (new_model_weights, new_model_biases,
          new_tile_weights, new_tile_biases) = self.get_layer_and_tile_weights(new_model)
 
-        assert_array_almost_equal(model_weights, new_model_weights)
-        assert_array_almost_equal(tile_weights, new_tile_weights)
-        if self.bias:
-            assert_array_almost_equal(model_biases, new_model_biases)
-            assert_array_almost_equal(tile_biases, new_tile_biases)
+        assert_array_almost_equal(
+            self.pack_weights(model_weights, model_biases, tile_weights, tile_biases),
+            self.pack_weights(new_model_weights, new_model_biases,
+                              new_tile_weights, new_tile_biases))
 
         # Asserts over the AnalogContext of the new model.
         self.assertTrue(hasattr(new_model.analog_tile.analog_ctx, 'analog_tile'))
@@ -167,12 +204,8 @@ class SerializationTest(ParametrizedTestCase):
 
         model = self.get_layer(rpu_config=rpu_config)
 
-        # Save the model to a file.
-        with TemporaryFile() as file:
-            save(model, file)
-            # Load the model.
-            file.seek(0)
-            new_model = load(file)
+        # Save the model to a file and load it back.
+        new_model = self.save_and_load(model)
 
         # Assert over the new model tile parameters.
         parameters = new_model.analog_tile.tile.get_parameters()
@@ -186,12 +219,8 @@ class SerializationTest(ParametrizedTestCase):
         model = self.get_layer()
         hidden_parameters = model.analog_tile.tile.get_hidden_parameters()
 
-        # Save the model to a file.
-        with TemporaryFile() as file:
-            save(model, file)
-            # Load the model.
-            file.seek(0)
-            new_model = load(file)
+        # Save the model to a file and load it back.
+        new_model = self.save_and_load(model)
 
         # Assert over the new model tile parameters.
         new_hidden_parameters = new_model.analog_tile.tile.get_hidden_parameters()
@@ -204,12 +233,8 @@ class SerializationTest(ParametrizedTestCase):
         alpha = 2.0
         model.analog_tile.tile.set_alpha_scale(alpha)
 
-        # Save the model to a file.
-        with TemporaryFile() as file:
-            save(model, file)
-            # Load the model.
-            file.seek(0)
-            new_model = load(file)
+        # Save the model to a file and load it back.
+        new_model = self.save_and_load(model)
 
         # Assert over the new model tile parameters.
         alpha_new = new_model.analog_tile.tile.get_alpha_scale()
@@ -222,12 +247,8 @@ class SerializationTest(ParametrizedTestCase):
         alpha = model.analog_tile.tile.get_alpha_scale()
         self.assertNotEqual(alpha, 1.0)
 
-        # Save the model to a file.
-        with TemporaryFile() as file:
-            save(model, file)
-            # Load the model.
-            file.seek(0)
-            new_model = load(file)
+        # Save the model to a file and load it back.
+        new_model = self.save_and_load(model)
 
         # Assert over the new model tile parameters.
         alpha_new = new_model.analog_tile.tile.get_alpha_scale()
@@ -239,13 +260,10 @@ class SerializationTest(ParametrizedTestCase):
         model = self.get_layer()
         hidden_parameters = model.analog_tile.tile.get_hidden_parameters()
 
-        # Save the model to a file.
-        with TemporaryFile() as file:
-            save(model.state_dict(), file)
-            # Load the model.
-            file.seek(0)
-            new_model = self.get_layer()
-            new_model.load_state_dict(load(file))
+        # Save the model to a file and load its state dict.
+        state_dict = self.save_and_load(model.state_dict())
+        new_model = self.get_layer()
+        new_model.load_state_dict(state_dict)
 
         # Assert over the new model tile parameters.
         new_hidden_parameters = new_model.analog_tile.tile.get_hidden_parameters()
@@ -260,22 +278,22 @@ class SerializationTest(ParametrizedTestCase):
         (model_weights, model_biases,
          tile_weights, tile_biases) = self.get_layer_and_tile_weights(children_layer)
 
-        self.assertIn('0.analog_tile_state', model.state_dict())
+        state_dict = model.state_dict()
+        self.assertIn('0.analog_tile_state', state_dict)
 
         # Update the state_dict of a new model.
         new_children_layer = self.get_layer()
         new_model = Sequential(new_children_layer)
-        new_model.load_state_dict(model.state_dict())
+        new_model.load_state_dict(state_dict)
 
         # Compare the new model weights and biases.
         (new_model_weights, new_model_biases, new_tile_weights, new_tile_biases) = \
             self.get_layer_and_tile_weights(new_children_layer)
 
-        assert_array_almost_equal(model_weights, new_model_weights)
-        assert_array_almost_equal(tile_weights, new_tile_weights)
-        if self.bias:
-            assert_array_almost_equal(model_biases, new_model_biases)
-            assert_array_almost_equal(tile_biases, new_tile_biases)
+        assert_array_almost_equal(
+            self.pack_weights(model_weights, model_biases, tile_weights, tile_biases),
+            self.pack_weights(new_model_weights, new_model_biases,
+                              new_tile_weights, new_tile_biases))
 
     def test_state_dict_children_layers_subclassing(self):
         """Test using the state_dict with children analog layers via subclassing."""
@@ -294,22 +312,22 @@ class SerializationTest(ParametrizedTestCase):
         (model_weights, model_biases, tile_weights, tile_biases) = \
             self.get_layer_and_tile_weights(children_layer)
 
-        self.assertIn('custom_child.analog_tile_state', model.state_dict())
+        state_dict = model.state_dict()
+        self.assertIn('custom_child.analog_tile_state', state_dict)
 
         # Update the state_dict of a new model.
         new_children_layer = self.get_layer()
         new_model = CustomModule(new_children_layer)
-        new_model.load_state_dict(model.state_dict())
+        new_model.load_state_dict(state_dict)
 
         # Compare the new model weights and biases.
         (new_model_weights, new_model_biases, new_tile_weights, new_tile_biases) = \
             self.get_layer_and_tile_weights(new_children_layer)
 
-        assert_array_almost_equal(model_weights, new_model_weights)
-        assert_array_almost_equal(tile_weights, new_tile_weights)
-        if self.bias:
-            assert_array_almost_equal(model_biases, new_model_biases)
-            assert_array_almost_equal(tile_biases, new_tile_biases)
+        assert_array_almost_equal(
+            self.pack_weights(model_weights, model_biases, tile_weights, tile_biases),
+            self.pack_weights(new_model_weights, new_model_biases,
+                              new_tile_weights, new_tile_biases))
 
     def test_state_dict_analog_strict(self):
         """Test the `strict` flag for analog layers."""
@@ -358,19 +376,19 @@ class SerializationTest(ParametrizedTestCase):
     def test_load_state_load_rpu_config(self):
         """Test creating a new model using a state dict, while using a different RPU config."""
 
-        # Create the device and the array.
+        # Skipped for FP, before building and serializing any layer.
+        if isinstance(self.get_rpu_config(), FloatingPointRPUConfig):
+            return
 
+        # Create the device and the array.
         model = self.get_layer()
         state_dict = model.state_dict()
 
-        rpu_config = deepcopy(model.analog_tile.rpu_config)
-
-        # Skipped for FP
-        if isinstance(rpu_config, FloatingPointRPUConfig):
-            return
-
-        old_value = rpu_config.forward.inp_noise
-        rpu_config.forward.inp_noise = 0.51
+        # Only the forward parameters are changed, so a shallow copy suffices.
+        old_rpu_config = model.analog_tile.rpu_config
+        old_value = old_rpu_config.forward.inp_noise
+        rpu_config = replace(old_rpu_config,
+                             forward=replace(old_rpu_config.forward, inp_noise=0.51))
 
         # Test restore_rpu_config=False
         new_model = self.get_layer(rpu_config=rpu_config)
@@ -389,14 +407,14 @@ class SerializationTest(ParametrizedTestCase):
     def test_load_state_load_rpu_config_wrong(self):
         """Test creating a new model using a state dict, while using a different RPU config."""
 
+        # Skipped for FP, before building and serializing any layer.
+        if isinstance(self.get_rpu_config(), FloatingPointRPUConfig):
+            return
+
         # Create the device and the array.
         model = self.get_layer()
         state_dict = model.state_dict()
 
-        # Skipped for FP
-        if isinstance(model.analog_tile.rpu_config, FloatingPointRPUConfig):
-            return
-
         rpu_config = FloatingPointRPUConfig()
 
         new_model = self.get_layer(rpu_config=rpu_config)